@@ -5,16 +5,56 @@ and send it to Telegram Channel - BursaDaily.
 """
 
 import pandas as pd
-from bs4 import BeautifulSoup as bs
+import lxml.html
 import requests
+import aiohttp
+import asyncio
+import orjson
 import urllib.parse
 import time
 import io
+import hashlib
+import shelve
 import fitz
 import os
 import telegram
 from telegram.utils.helpers import escape_markdown
 
+# Shared HTTP session for the synchronous requests
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+
+# Minimum seconds between messages sent to the same chat (about 20 per minute for a channel)
+SEND_INTERVAL = 3
+
+# Persistent cache of Telegram photo file_id for PDFs already posted
+PHOTO_CACHE = 'sent_pdfs.db'
+
+# Full names of broker houses by source label
+BROKER_HOUSE = {
+    'BIMB': 'BIMB Securities Research',
+    'PUBLIC BANK': 'PublicInvest Research',
+    'MIDF': 'MIDF Research',
+    'KENANGA': 'Kenanga Research',
+    'HLG': 'Hong Leong Investment Bank Research',
+    'AmInvest': 'AmInvest Research',
+    'AffinHwang': 'Affin Hwang Research',
+    'JF APEX': 'JF Apex Securities Research',
+    'MalaccaSecurities': 'Mplus Research',
+    'RHB-OSK': 'RHB Securities Research',
+    'ALLIANCE': 'Alliance Research',
+    'MERCURY': 'Mercury Research',
+    'TA': 'TA Research',
+    'Rakuten': 'Rakuten Research',
+    'MACQUARIE GROUP': 'Macquarie Research',
+    'CIMB': 'CIMB Research',
+    'CREDIT SUISSE': 'Credit Suisse',
+    'UBS': 'UBS Research',
+    'CITI GROUP': 'Citi Research',
+    'UOBKayHian': 'UOB Kay Hian'
+}
+
 
 def main():
     DATE = pd.Timestamp.today(
@@ -39,78 +79,88 @@ def main():
         stocks_df = get_stocks()
 
         # If 'all new' i.e. 50 rows of price target, then check individual stocks if any new price target
-        stocks = latest_df['Code'].unique().tolist()
+        stocks = set(latest_df['Code'])
         if len(latest_df) == 50:
             last_row = latest_df.loc[49, 'Code']
-            cond = stocks_df['Code'] > last_row
-            stocks = stocks + stocks_df[cond]['Code'].tolist()
-            stocks = sorted(list(set(stocks)))
-
-        # Load price target for each stock into dataframe
-        appended_df = [get_price_target_by_stock(stock) for stock in stocks]
-        report_df = pd.concat(appended_df, ignore_index=True)
-
-        # Filter latest price
-        is_latest = report_df['Date'] >= DATE
-        new_report_df = report_df[is_latest].copy().reset_index(drop=True)
-        new_report_df = new_report_df.sort_values(
-            by=['Date', 'Code'], ignore_index=True)
-
-        # Extract details info for price target
-        new_report_df['Title'], new_report_df['Post'], new_report_df['Pdf'] = zip(
-            *new_report_df['Link'].apply(get_link_details))
-
-        # Add columns from stock_df into dataframe
-        new_report_df = new_report_df.merge(stocks_df, how='left', on='Code')
-
-        # Generate potential changes based on last and target price
-        new_report_df['Change'] = new_report_df.apply(
-            lambda x: get_change(x['Last Price'], x['Target Price']), axis=1)
-
-        # Generate caption and text message
-        new_report_df['Caption'], new_report_df['Text'] = zip(
-            *new_report_df.apply(generate_caption_text, axis=1))
-
-        # Send latest reports to Telegram Channel
-        new_report_df['Status'] = ''
-        for index, row in new_report_df.iterrows():
-            # Initialise var to check if message has been sent
-            not_sent = True
-            if row['Pdf'] != '':
-                try:
-                    response = requests.get(
-                        f"https:{urllib.parse.quote(row['Pdf'])}")
-                    content_type = response.headers.get('content-type')
-
-                    if 'application/pdf' in content_type:
-                        png = generate_photo(response.content)
-                        bot.send_photo(
+            stocks.update(stocks_df.loc[stocks_df['Code'] > last_row, 'Code'])
+        stocks = sorted(stocks)
+
+        # Load price target and details info for each stock into dataframe
+        with shelve.open(PHOTO_CACHE) as cache:
+            new_report_df, failed = asyncio.run(
+                get_new_reports(stocks, DATE, cache))
+            new_report_df['Status'] = ''
+
+            if len(new_report_df) > 0:
+                # Add columns from stock_df into dataframe
+                stock_map = dict(zip(stocks_df['Code'], stocks_df['Stock']))
+                price_map = dict(zip(stocks_df['Code'], stocks_df['Last Price']))
+                new_report_df['Stock'] = new_report_df['Code'].map(
+                    stock_map).fillna(new_report_df['Code'])
+                new_report_df['Last Price'] = new_report_df['Code'].map(price_map)
+
+                # Generate potential changes based on last and target price
+                new_report_df['Change'] = new_report_df.apply(
+                    lambda x: get_change(x['Last Price'], x['Target Price']), axis=1)
+
+                # Generate caption and text message
+                new_report_df['Caption'], new_report_df['Text'] = generate_caption_text(
+                    new_report_df)
+
+                # Send latest reports to Telegram Channel
+                last_sent = 0
+                for index, row in new_report_df.iterrows():
+                    # Initialise var to check if message has been sent
+                    not_sent = True
+
+                    # Reuse file_id of a previously uploaded photo if available
+                    key, photo, cached = None, None, False
+                    if row['Pdf'] != '':
+                        key = get_pdf_key(row['Pdf'])
+                        photo = cache.get(key)
+                        cached = photo is not None
+                        if not cached:
+                            photo = prepare_photo(row['PdfBytes'])
+
+                    wait = last_sent + SEND_INTERVAL - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+
+                    if photo is not None:
+                        try:
+                            message = send_with_retry(
+                                bot.send_photo,
+                                chat_id=CHAT_ID,
+                                photo=photo,
+                                caption=row['Caption'],
+                                parse_mode=telegram.ParseMode.MARKDOWN_V2,
+                                disable_notification=True,
+                                timeout=30
+                            )
+                            not_sent = False
+                            new_report_df.at[index, 'Status'] = 'Sent'
+                            cache[key] = message.photo[-1].file_id
+                        except telegram.error.BadRequest as e:
+                            # Drop a cached file_id that Telegram no longer accepts
+                            if cached and 'file' in e.message.lower():
+                                del cache[key]
+                        except:
+                            pass
+
+                    if not_sent:
+                        send_with_retry(
+                            bot.send_message,
                             chat_id=CHAT_ID,
-                            photo=png,
-                            caption=row['Caption'],
+                            text=row['Text'],
                             parse_mode=telegram.ParseMode.MARKDOWN_V2,
                             disable_notification=True,
                             timeout=30
                         )
-                        not_sent = False
                         new_report_df.at[index, 'Status'] = 'Sent'
-                        time.sleep(3)
-                except:
-                    pass
-
-            if not_sent:
-                bot.send_message(
-                    chat_id=CHAT_ID,
-                    text=row['Text'],
-                    parse_mode=telegram.ParseMode.MARKDOWN_V2,
-                    disable_notification=True,
-                    timeout=30
-                )
-                new_report_df.at[index, 'Status'] = 'Sent'
-                time.sleep(3)
+                    last_sent = time.monotonic()
 
         # Send error/completion message
-        if new_report_df[new_report_df['Status'] != 'Sent'].shape[0] > 0:
+        if failed > 0 or new_report_df[new_report_df['Status'] != 'Sent'].shape[0] > 0:
             bot.send_message(
                 chat_id=CHAT_ID_LOG,
                 text='Not all reports are submitted.',
@@ -126,19 +176,25 @@ def main():
             )
 
 
-def fetch(url):
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    response = requests.get(url, headers=headers)
-    soup = bs(response.text, 'html.parser')
+async def aread(session, url):
+    async with session.get(url) as response:
+        content = await response.read()
+
+    return content
+
 
-    return soup
+async def afetch_tree(session, url):
+    content = await aread(session, url)
+    tree = lxml.html.fromstring(content)
+
+    return tree
 
 
 def get_latest_price_target(date):
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    response = requests.get(
-        'http://klse.i3investor.com/jsp/pt.jsp', headers=headers)
-    df = pd.read_html(response.text, attrs={'class': 'nc'})[0]
+    response = SESSION.get(
+        'http://klse.i3investor.com/jsp/pt.jsp', timeout=15)
+    df = pd.read_html(io.BytesIO(response.content),
+                      flavor='lxml', attrs={'class': 'nc'})[0]
     df.rename(columns={'Stock Name': 'Code'}, inplace=True)
 
     df['Date'] = pd.to_datetime(df['Date'], format='%d/%m/%Y')
@@ -148,78 +204,139 @@ def get_latest_price_target(date):
 
 
 def get_stocks():
-    headers = {'User-Agent': 'Mozilla/5.0'}
     data = {'screener_lists': ['all-stock'], 'screener_option_lists': [],
             'criteria_lists': {}, 'column_lists': ["s_symbol"], 'is_default_column': True}
-    response = requests.post(
-        'https://www.isaham.my/iscanner', headers=headers, json=data)
-    df = pd.DataFrame(response.json()['result'], columns=response.json()[
-                      'header'])[['Stock', 'Last Price']]
+    response = SESSION.post(
+        'https://www.isaham.my/iscanner', json=data, timeout=15)
+    result = orjson.loads(response.content)
+    df = pd.DataFrame(result['result'], columns=result['header'])[
+        ['Stock', 'Last Price']]
     df['Code'] = df['Stock'].str.replace(' [NS]', '', regex=False)
 
     return df
 
 
-def get_price_target_by_stock(stock):
-    soup = fetch(
-        f"https://klse.i3investor.com/ptservlet.jsp?sa=pts&q={urllib.parse.quote(stock)}")
-    table = soup.find('table', attrs={'class': 'nc'})
+async def get_new_reports(stocks, date, cache):
+    # Per-host connection limit keeps the concurrent scraping polite
+    connector = aiohttp.TCPConnector(limit_per_host=16, keepalive_timeout=30)
+    # Time out on connect/read only, not while queued for a free connection
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=30)
+    async with aiohttp.ClientSession(connector=connector, headers=HEADERS, timeout=timeout,
+                                     raise_for_status=True) as session:
+        # A stock page that fails to load or parse is counted and skipped
+        results = await asyncio.gather(
+            *(aget_price_target_by_stock(session, stock) for stock in stocks),
+            return_exceptions=True)
+
+        # Build a single dataframe from the records of all stocks
+        columns, all_records = [], []
+        failed = 0
+        for result in results:
+            if isinstance(result, Exception):
+                failed += 1
+                continue
+            stock_columns, records = result
+            if records:
+                columns = stock_columns
+                all_records.extend(records)
+        report_df = pd.DataFrame(data=all_records, columns=columns)
+        if report_df.empty:
+            return report_df, failed
+
+        report_df[['Open Price', 'Target Price']] = report_df[['Open Price', 'Target Price']].apply(
+            pd.to_numeric, errors='coerce')
+        report_df['Date'] = pd.to_datetime(report_df['Date'], format='%d/%m/%Y')
+
+        # Filter latest price
+        is_latest = report_df['Date'] >= date
+        new_report_df = report_df[is_latest].sort_values(
+            by=['Date', 'Code'], ignore_index=True)
+        if new_report_df.empty:
+            return new_report_df, failed
+
+        # Extract details info for price target
+        # Each distinct link is fetched once even if shared across stocks
+        links = new_report_df['Link'].unique()
+        details = await asyncio.gather(
+            *(aget_link_details(session, link, cache) for link in links),
+            return_exceptions=True)
+        details = {link: ('', '', '', '', None) if isinstance(detail, Exception) else detail
+                   for link, detail in zip(links, details)}
+        new_report_df['Title'], new_report_df['Post'], new_report_df['Pdf'], new_report_df['PdfUrl'], new_report_df['PdfBytes'] = zip(
+            *new_report_df['Link'].map(details))
+
+    return new_report_df, failed
+
+
+async def aget_price_target_by_stock(session, stock):
+    content = await aread(
+        session, f"https://klse.i3investor.com/ptservlet.jsp?sa=pts&q={urllib.parse.quote(stock)}")
+    table = lxml.html.fromstring(content).xpath('//table[@class="nc"]')
     if table:
-        if not table.find('span', attrs={'class': 'warn'}):
-            rows = table.find_all('tr')
-            records = []
-            columns = []
-            for row in rows:
-                headers = row.find_all('th')
-                if headers != []:
-                    columns = [header.text for header in headers]
-                else:
-                    cols = row.find_all('td')
-                    record = [col.text.strip() for col in cols]
-                    link = cols[6].a['href']
-                    record.insert(7, link)
-                    records.append(record)
-
-            columns.insert(7, 'Link')
-            df = pd.DataFrame(data=records, columns=columns)
+        if not table[0].xpath('.//span[@class="warn"]'):
+            df = pd.read_html(io.BytesIO(content), flavor='lxml',
+                              attrs={'class': 'nc'}, keep_default_na=False)[0]
+            # First link in the 7th cell of each row, one per row
+            links = [row.xpath('string((td[7]//a/@href)[1])')
+                     for row in table[0].xpath('.//tr[td]')]
+            df.insert(7, 'Link', links)
             df.insert(0, 'Code', stock)
-            df[['Open Price', 'Target Price']] = df[['Open Price', 'Target Price']].apply(
-                pd.to_numeric, errors='coerce')
-            df['Date'] = pd.to_datetime(df['Date'], format='%d/%m/%Y')
 
-            return df
+            return df.columns.tolist(), df.values.tolist()
 
-    return None
+    return [], []
 
 
-def get_link_details(link):
-    soup = fetch(f"https://klse.i3investor.com{link}")
-    post, title, pdf = [''] * 3
+async def aget_link_details(session, link, cache):
+    tree = await afetch_tree(session, f"https://klse.i3investor.com{link}")
+    post, title, pdf, pdf_url = [''] * 4
+    content = None
 
-    h2 = soup.find('h2')
+    h2 = tree.xpath('//h2')
     if h2:
-        title = h2.text
+        title = h2[0].text_content()
+
+    p = tree.xpath(
+        '(//div[contains(concat(" ", normalize-space(@class), " "), " doccontent ")])[1]//p')
+    if p:
+        href = p[-1].xpath('.//a/@href')
+        if href:
+            post = href[0]
+            if post:
+                pdf = await aget_pdf(session, post)
+                if pdf:
+                    pdf_url = f"https:{urllib.parse.quote(pdf)}"
+                    # Skip download for PDFs already posted as a photo
+                    if get_pdf_key(pdf) not in cache:
+                        content = await aget_pdf_content(session, pdf_url)
+
+    return title, post, pdf, pdf_url, content
+
+
+async def aget_pdf(session, post):
+    tree = await afetch_tree(session, f"https://klse.i3investor.com{post}")
+    pdf = tree.xpath('//object/@data')
+    if pdf:
+        return pdf[0]
 
-    content = soup.find('div', {'class': 'doccontent'})
-    if content:
-        p = content.find_all('p')
-        if p:
-            a = p[-1].find('a', href=True)
-            if a:
-                post = a['href']
-                if post:
-                    pdf = get_pdf(post)
+    return ''
 
-    return title, post, pdf
 
+async def aget_pdf_content(session, pdf_url):
+    try:
+        async with session.get(pdf_url) as response:
+            content_type = response.headers.get('content-type', '')
 
-def get_pdf(post):
-    soup = fetch(f"https://klse.i3investor.com{post}")
-    pdf = soup.find('object')
-    if pdf:
-        return pdf['data']
+            if 'application/pdf' in content_type:
+                return await response.read()
+    except:
+        pass
+
+    return None
 
-    return ''
+
+def get_pdf_key(pdf):
+    return hashlib.sha1(pdf.encode()).hexdigest()
 
 
 def format_price(value):
@@ -249,58 +366,61 @@ def get_change(current, target):
     return change
 
 
-def generate_caption_text(row):
-    broker_house = {
-        'BIMB': 'BIMB Securities Research',
-        'PUBLIC BANK': 'PublicInvest Research',
-        'MIDF': 'MIDF Research',
-        'KENANGA': 'Kenanga Research',
-        'HLG': 'Hong Leong Investment Bank Research',
-        'AmInvest': 'AmInvest Research',
-        'AffinHwang': 'Affin Hwang Research',
-        'JF APEX': 'JF Apex Securities Research',
-        'MalaccaSecurities': 'Mplus Research',
-        'RHB-OSK': 'RHB Securities Research',
-        'ALLIANCE': 'Alliance Research',
-        'MERCURY': 'Mercury Research',
-        'TA': 'TA Research',
-        'Rakuten': 'Rakuten Research',
-        'MACQUARIE GROUP': 'Macquarie Research',
-        'CIMB': 'CIMB Research',
-        'CREDIT SUISSE': 'Credit Suisse',
-        'UBS': 'UBS Research',
-        'CITI GROUP': 'Citi Research',
-        'UOBKayHian': 'UOB Kay Hian'
-    }
-
-    name = escape_markdown(row['Stock'], version=2)
-    last = escape_markdown(f"{format_price(row['Last Price'])}", version=2)
-    tp = escape_markdown(f"{format_price(row['Target Price'])}", version=2)
-    change = escape_markdown(row['Change'], version=2)
-    call = escape_markdown(row['Price Call'].title(), version=2)
-    title = escape_markdown(row['Title'], version=2)
-    date = escape_markdown(row['Date'].strftime('(%d/%m/%Y)'), version=2)
-    if row['Source'] in broker_house:
-        broker = escape_markdown(broker_house[row['Source']], version=2)
-    else:
-        broker = escape_markdown(row['Source'], version=2)
-    link = escape_markdown(
-        f"https://klse.i3investor.com{row['Link']}", version=2)
-    pdf = escape_markdown(f"https:{urllib.parse.quote(row['Pdf'])}", version=2)
+def generate_caption_text(df):
+    def escape(series):
+        return series.map(lambda x: escape_markdown(x, version=2))
 
-    caption = f"*{name}* \({call}\) Last: RM{last}\nTarget: RM{tp} {change}\n[{title}]({pdf}) by {broker} {date}\n\n{link}"
-    text = f"*{name}* \({call}\) Last: RM{last}\nTarget: RM{tp} {change}\nResearch report by {broker} {date}\n\n{link}"
+    name = escape(df['Stock'])
+    last = escape(df['Last Price'].map(format_price))
+    tp = escape(df['Target Price'].map(format_price))
+    change = escape(df['Change'])
+    call = escape(df['Price Call'].str.title())
+    title = escape(df['Title'])
+    date = escape(df['Date'].dt.strftime('(%d/%m/%Y)'))
+    broker = escape(df['Source'].map(BROKER_HOUSE).fillna(df['Source']))
+    link = escape('https://klse.i3investor.com' + df['Link'])
+    pdf = escape(df['PdfUrl'])
+
+    header = '*' + name + '* \\(' + call + '\\) Last: RM' + last + \
+        '\nTarget: RM' + tp + ' ' + change + '\n'
+    caption = header + '[' + title + '](' + pdf + ') by ' + \
+        broker + ' ' + date + '\n\n' + link
+    text = header + 'Research report by ' + broker + ' ' + date + '\n\n' + link
 
     return caption, text
 
 
+def send_with_retry(send, retries=3, **kwargs):
+    for attempt in range(retries):
+        # Rewind photo stream in case an earlier attempt consumed it
+        photo = kwargs.get('photo')
+        if hasattr(photo, 'seek'):
+            photo.seek(0)
+
+        try:
+            return send(**kwargs)
+        except telegram.error.RetryAfter as e:
+            if attempt == retries - 1:
+                raise
+            time.sleep(e.retry_after)
+
+
+def prepare_photo(content):
+    if content is not None:
+        try:
+            return generate_photo(content)
+        except:
+            pass
+
+    return None
+
+
 def generate_photo(content):
-    pdf = io.BytesIO(content)
-    doc = fitz.open(stream=pdf, filetype='pdf')
-    page = doc[0]
-    trans = fitz.Matrix(150/72, 150/72)
-    pix = page.getPixmap(matrix=trans)
-    png = io.BytesIO(pix.getPNGData())
+    with fitz.open(stream=content, filetype='pdf') as doc:
+        page = doc.load_page(0)
+        trans = fitz.Matrix(100/72, 100/72)
+        pix = page.get_pixmap(matrix=trans, alpha=False)
+        png = io.BytesIO(pix.tobytes('png'))
 
     return png
 